@@ -4,6 +4,9 @@
 """ASkiBot, cloned from IRC to TG because newfags can't even."""
 
 import tgbot
+import diagnostics
+import tracing
+import quotearchive
 import logging
 import socket
 import threading
@@ -12,10 +15,21 @@ import random
 import errno
 import pickle
 import collections
+import json
+import os
+import array
+import bisect
+import unicodedata
+import tracemalloc
 
 TOKEN_TXT = 'token.txt'
 KEULII_TXT = 'keulii.txt'
 QUOTES_DIR = 'quotes'
+ADMINS_TXT = 'admins.txt'
+DIAG_DIR = 'diag'
+TRACE_FILE = 'trace.json'
+# seconds; faster traces are thrown away
+TRACE_SLOW = 2.0
 MOPOPOSTERPORT = 6688
 
 class Mopoposter:
@@ -34,6 +48,7 @@ class Mopoposter:
         self.sendfunc = sendfunc
         self.serversocket = None
         self.thread = None
+        self.received = 0
 
     def start(self):
         self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -68,7 +83,9 @@ class Mopoposter:
             pass
         else:
             if len(msg) > 0:
-                self.sendfunc(msg.decode(self.ENCODING))
+                self.received += 1
+                with tracing.trace('mopoposter', 'mopoposter:%d' % self.received):
+                    self.sendfunc(msg.decode(self.ENCODING))
         finally:
             sock.shutdown(socket.SHUT_RDWR)
             sock.close()
@@ -80,6 +97,149 @@ class Mopoposter:
         if self.thread:
             self.thread.join()
 
+class UpdatePoller:
+    """Long poll for updates, fetching the next batch in the background.
+
+    The next batch is requested as soon as the current one has arrived, so
+    the network round trip overlaps with handling the current updates. Note
+    that this acknowledges the current batch to the server early.
+
+    The batch limit doubles when the server fills it (a backlog is waiting)
+    and halves back when the batches get small again.
+    """
+    POLL_TIMEOUT = 60
+    MIN_LIMIT = 10
+    MAX_LIMIT = 100 # tg api maximum
+
+    def __init__(self, conn, offset=0):
+        self.conn = conn
+        self.offset = offset
+        self.limit = self.MIN_LIMIT
+        # polls, empty_polls, updates, max_batch
+        self.stats = collections.Counter()
+        self.thread = None
+        self.result = None
+
+    def fetch(self, offset, limit):
+        """Run in the prefetch thread; errors are passed back to poll()."""
+        try:
+            self.result = self.conn.getUpdates(offset=offset, limit=limit,
+                    timeout=self.POLL_TIMEOUT)
+        except Exception as ex:
+            self.result = ex
+
+    def prefetch(self):
+        self.thread = threading.Thread(target=self.fetch,
+                args=(self.offset, self.limit), daemon=True)
+        self.thread.start()
+
+    def poll(self):
+        """Return the next batch of updates, possibly empty."""
+        if self.thread is None:
+            self.prefetch()
+        self.thread.join()
+        self.thread = None
+        batch = self.result
+        self.result = None
+        if isinstance(batch, Exception):
+            raise batch
+
+        self.account(batch)
+        if batch:
+            self.offset = batch[-1]['update_id'] + 1
+            self.prefetch()
+        # an empty poll waits for the next one to be asked for; there's
+        # nothing to overlap with anyway
+        return batch
+
+    def account(self, batch):
+        """Update the statistics and adapt the limit to the batch size."""
+        self.stats['polls'] += 1
+        self.stats['updates'] += len(batch)
+        if not batch:
+            self.stats['empty_polls'] += 1
+        self.stats['max_batch'] = max(self.stats['max_batch'], len(batch))
+
+        if len(batch) >= self.limit:
+            self.limit = min(2 * self.limit, self.MAX_LIMIT)
+        elif len(batch) < self.limit // 4:
+            self.limit = max(self.limit // 2, self.MIN_LIMIT)
+
+class TokenBucket:
+    """Allow bursts of some events, refilled at a constant rate per second."""
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def full(self):
+        return self.tokens >= self.burst
+
+class AdmissionControl:
+    """Decide whether a command is worth handling at all.
+
+    Each command costs one token from the user's, the chat's and the global
+    bucket, but only if all three have one left; a user flooding a chat thus
+    doesn't eat the chat's share. The global rate keeps the bot below the
+    api limits for all chats together.
+    """
+    USER_RATE = 1/6
+    USER_BURST = 5
+    CHAT_RATE = 1/3
+    CHAT_BURST = 10
+    GLOBAL_RATE = 20
+    GLOBAL_BURST = 30
+    # drop idle buckets now and then so that the dicts don't grow forever
+    PRUNE_EVERY = 1000
+
+    def __init__(self):
+        self.users = {}
+        self.chats = {}
+        self.total = TokenBucket(self.GLOBAL_RATE, self.GLOBAL_BURST,
+                time.monotonic())
+        # admitted, rejected_user, rejected_chat, rejected_global
+        self.stats = collections.Counter()
+
+    def admit(self, chat_id, user_id):
+        """Take a token for this command; False if it should be dropped."""
+        now = time.monotonic()
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = TokenBucket(
+                    self.USER_RATE, self.USER_BURST, now)
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = TokenBucket(
+                    self.CHAT_RATE, self.CHAT_BURST, now)
+
+        for name, bucket in (('user', user), ('chat', chat),
+                ('global', self.total)):
+            bucket.refill(now)
+            if bucket.tokens < 1:
+                self.stats['rejected_' + name] += 1
+                return False
+
+        user.tokens -= 1
+        chat.tokens -= 1
+        self.total.tokens -= 1
+        self.stats['admitted'] += 1
+        if self.stats['admitted'] % self.PRUNE_EVERY == 0:
+            self.prune(now)
+        return True
+
+    def prune(self, now):
+        for buckets in (self.users, self.chats):
+            for key, bucket in list(buckets.items()):
+                bucket.refill(now)
+                if bucket.full():
+                    del buckets[key]
+
 class QuotesBase:
     """Get a random quote for a chat channel."""
     TIME_LIMIT = 15*60
@@ -109,15 +269,89 @@ class QuotesBase:
 
     def _search(self, chan_id, term):
         """Find that message on a chat channel."""
-        term = term.lower().strip()
-        lines = [x.strip() for x in self._listQuotes(chan_id)
-                if term in x.lower()]
-        return random.choice(lines) if len(lines) else None
+        with tracing.span('_search', chan=chan_id, term=term):
+            term = term.lower().strip()
+            lines = [x.strip() for x in self._listQuotes(chan_id)
+                    if term in x.lower()]
+            return random.choice(lines) if len(lines) else None
 
     def _listQuotes(self):
         """Subclasses should do this"""
         raise NotImplementedError
 
+def decodeLine(raw):
+    """utf8 if it is that, otherwise the old latin-1; the file has both"""
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return raw.decode('latin-1')
+
+def searchKey(text, fold_accents=False):
+    """Normalized, casefolded form of text for comparing in searches.
+
+    With fold_accents, also ä matches a and ö matches o, and so on."""
+    key = unicodedata.normalize('NFC', text).casefold()
+    if fold_accents:
+        key = ''.join(c for c in unicodedata.normalize('NFD', key)
+                if not unicodedata.combining(c))
+    return key
+
+class KeuliiCorpus:
+    """The keulii file's lines, read again only when the file changes.
+
+    The search keys (see searchKey) of all lines are made when reading, and
+    kept as one newline-separated string with the line start offsets next to
+    it. A search is then a few str.find calls instead of a pass over the
+    lines.
+
+    Can be shared by several Keulii instances, also from many threads.
+    """
+    def __init__(self, filename, fold_accents=False):
+        self.filename = filename
+        self.fold_accents = fold_accents
+        # (stat key, lines, keys, starts), replaced as a whole
+        self.cache = (None, [], '', array.array('L', [0]))
+
+    def load(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return self.cache
+        key = (st.st_mtime_ns, st.st_size)
+        if key != self.cache[0]:
+            try:
+                with open(self.filename, 'rb') as fh:
+                    raw = fh.read()
+            except IOError:
+                return self.cache
+            lines = [line for line in map(str.strip,
+                map(decodeLine, raw.split(b'\n'))) if line]
+            keys = [searchKey(line, self.fold_accents) for line in lines]
+            starts = array.array('L', [0])
+            for k in keys:
+                starts.append(starts[-1] + len(k) + 1)
+            self.cache = (key, lines, '\n'.join(keys) + '\n', starts)
+        return self.cache
+
+    def lines(self):
+        return self.load()[1]
+
+    def search(self, term):
+        """All lines that have term in them."""
+        _, lines, keys, starts = self.load()
+        term = searchKey(term.strip(), self.fold_accents)
+        if not term:
+            return lines
+        if '\n' in term:
+            return []
+        found = []
+        pos = keys.find(term)
+        while pos != -1:
+            i = bisect.bisect_right(starts, pos) - 1
+            found.append(lines[i])
+            pos = keys.find(term, starts[i + 1])
+        return found
+
 class Keulii(QuotesBase):
     """One global quotefile for all chats.
 
@@ -125,39 +359,121 @@ class Keulii(QuotesBase):
     Adding not supported, since it's done elsewhere.
     They're just read in here.
     """
-    def __init__(self, filename):
+    def __init__(self, filename, corpus=None):
         super().__init__()
         self.filename = filename
+        self.corpus = corpus if corpus is not None else KeuliiCorpus(filename)
+
+    def _search(self, chan_id, term):
+        with tracing.span('_search', chan=chan_id, term=term):
+            lines = self.corpus.search(term)
+            return random.choice(lines) if lines else None
 
     def _listQuotes(self, chan_id):
-        try:
-            # FIXME utf8
-            with open(self.filename, encoding='latin-1') as fh:
-                return list(fh)
-        except IOError:
-            return []
+        return self.corpus.lines()
 
 class Quotes(QuotesBase):
-    """Unique quote file for each chat."""
+    """Unique quote file for each chat.
+
+    The files are quote archives (see quotearchive); a random pick
+    decompresses just one block of one. Old pickled files still work and are
+    converted on the next add.
+
+    A set of the quotes' keys (see quoteKeys) is kept next to each file so
+    that duplicates are caught without reading all the quotes in. So are the
+    statistics (see quoteStats), updated on each add.
+    """
     def __init__(self, quotefile_dir):
         super().__init__()
         self.quotefile_dir = quotefile_dir
+        self.indexes = {}
+        self.stats = {}
+
+    def _filename(self, chan_id):
+        return '%s/%s' % (self.quotefile_dir, chan_id)
 
     def _listQuotes(self, chan_id):
         try:
-            with open('%s/%s' % (self.quotefile_dir, chan_id), 'rb') as fh:
-                return pickle.load(fh)
+            return loadQuotes(self._filename(chan_id))
         except IOError:
             return []
+        except ValueError as err:
+            logging.error('Broken quote file for %s: %s' % (chan_id, err))
+            return []
 
-    def addQuote(self, chan_id, quote):
-        quotes = self._listQuotes(chan_id)
-        quotes.append(quote)
-        with open('%s/%s' % (self.quotefile_dir, chan_id), 'wb') as fh:
-            pickle.dump(quotes, fh)
-
+    def _search(self, chan_id, term):
+        if term.strip():
+            return super()._search(chan_id, term)
+        with tracing.span('_search', chan=chan_id, term=term):
+            try:
+                quote = randomQuote(self._filename(chan_id))
+            except IOError:
+                return None
+            except ValueError as err:
+                logging.error('Broken quote file for %s: %s' % (chan_id, err))
+                return None
+            return quote.strip() if quote is not None else None
+
+    def _index(self, chan_id):
+        index = self.indexes.get(chan_id)
+        if index is None:
+            try:
+                with open(self._filename(chan_id) + INDEX_SUFFIX, 'rb') as fh:
+                    index = pickle.load(fh)
+            except IOError:
+                # older archive; this happens just once
+                index = quoteIndex(self._listQuotes(chan_id))
+            except (EOFError, pickle.UnpicklingError) as err:
+                logging.error('Broken quote index for %s: %s' % (chan_id, err))
+                index = quoteIndex(self._listQuotes(chan_id))
+            self.indexes[chan_id] = index
+        return index
+
+    def getStats(self, chan_id):
+        stats = self.stats.get(chan_id)
+        if stats is None:
+            stats = loadStats(self._filename(chan_id))
+            if stats is None:
+                stats = quoteStats(self._listQuotes(chan_id))
+            self.stats[chan_id] = stats
+        return stats
 
-class TgQuote(collections.namedtuple('TgQuoteBase', 'origin msgid text adder')):
+    def addQuote(self, chan_id, quote):
+        """Append a quote unless it's there already; False if it was."""
+        keys = quoteKeys(quote)
+        index = self._index(chan_id)
+        if not index.isdisjoint(keys):
+            return False
+
+        index |= keys
+        stats = self.getStats(chan_id)
+        countQuote(stats, quote, time.time())
+        filename = self._filename(chan_id)
+        try:
+            archived = quotearchive.isArchive(filename)
+        except IOError:
+            archived = False
+        try:
+            if archived:
+                quotearchive.append(filename, encodeQuote(quote))
+                saveQuoteIndex(filename, index, stats)
+            else:
+                # new, or an old pickle to convert
+                quotes = self._listQuotes(chan_id)
+                quotes.append(quote)
+                saveQuotes(filename, quotes, index, stats)
+        except Exception:
+            # the cached index and stats have this quote already; reload
+            # them from the files next time
+            self.indexes.pop(chan_id, None)
+            self.stats.pop(chan_id, None)
+            raise
+        return True
+
+# msgid is the id of the forward in the adder's private chat with the bot;
+# date is the original message's forward_date, missing in old quotes
+class TgQuote(collections.namedtuple('TgQuoteBase', 'origin msgid text adder date',
+        defaults=(None,))):
     def strip(self):
         return self
 
@@ -172,10 +488,169 @@ class TgQuote(collections.namedtuple('TgQuoteBase', 'origin msgid text adder')):
             self.origin.get('last_name', ''),
             self.text)).lower()
 
+INDEX_SUFFIX = '.index'
+STATS_SUFFIX = '.stats'
+
+def normalizeText(text):
+    """Casefolded words only, so that trivial edits still look the same"""
+    return ' '.join(''.join(c if c.isalnum() else ' '
+        for c in text.casefold()).split())
+
+def textKey(text):
+    """normalizeText, or just casefolded if that leaves nothing (emoji etc.)"""
+    return normalizeText(text) or text.strip().casefold()
+
+def quoteKeys(quote):
+    """The set of keys that identify a quote for duplicate detection.
+
+    Forwards are keyed on the origin user's id with the normalized text, and
+    with the original message's date, which identifies the same message
+    forwarded again. The forward's own msgid is unique only within the
+    adder's chat with the bot, so it's scoped with the adder. Plain strings
+    have just the text."""
+    if isinstance(quote, TgQuote):
+        origin = quote.origin.get('id')
+        keys = {('adder_msg', quote.adder.get('id'), quote.msgid),
+                ('text', origin, textKey(quote.text))}
+        if quote.date is not None:
+            keys.add(('fwd', origin, quote.date))
+        return keys
+    return {('text', None, textKey(quote))}
+
+def quoteIndex(quotes):
+    index = set()
+    for quote in quotes:
+        index |= quoteKeys(quote)
+    return index
+
+def dedupeQuotes(quotes):
+    """Keep the first one of each duplicate, in order."""
+    seen = set()
+    unique = []
+    for quote in quotes:
+        keys = quoteKeys(quote)
+        if seen.isdisjoint(keys):
+            unique.append(quote)
+            seen |= keys
+    return unique
+
+def quoteStats(quotes=()):
+    """Counts per quoted user, per adder and per month of adding.
+
+    Plain dicts and counters, so that they unpickle anywhere. Users are keyed
+    on id, with the latest name seen in names. Quotes don't remember when they
+    were added, so months count only those added after the stats existed
+    (see rebuildStats)."""
+    stats = {
+        'total': 0,
+        'origins': collections.Counter(),
+        'adders': collections.Counter(),
+        'months': collections.Counter(),
+        'names': {},
+    }
+    for quote in quotes:
+        countQuote(stats, quote)
+    return stats
+
+def countQuote(stats, quote, when=None):
+    stats['total'] += 1
+    if isinstance(quote, TgQuote):
+        for kind, user in (('origins', quote.origin), ('adders', quote.adder)):
+            stats[kind][user.get('id')] += 1
+            stats['names'][user.get('id')] = getUserDesc(user)
+    if when is not None:
+        stats['months'][time.strftime('%Y-%m', time.localtime(when))] += 1
+
+def encodeQuote(quote):
+    """One archive record: TgQuotes as json lists, plain strings as is.
+
+    Unlike pickles, these don't depend on where TgQuote was defined."""
+    obj = list(quote) if isinstance(quote, TgQuote) else quote
+    return json.dumps(obj, ensure_ascii=False,
+            separators=(',', ':')).encode('utf-8')
+
+def decodeQuote(record):
+    obj = json.loads(record.decode('utf-8'))
+    return TgQuote(*obj) if isinstance(obj, list) else obj
+
+def loadQuotes(filename):
+    """All quotes of a file, either an archive or an old pickle."""
+    if quotearchive.isArchive(filename):
+        with quotearchive.Reader(filename) as reader:
+            return [decodeQuote(r) for r in reader.records()]
+    with open(filename, 'rb') as fh:
+        return pickle.load(fh)
+
+def randomQuote(filename):
+    """One random quote, or None if there are none."""
+    if quotearchive.isArchive(filename):
+        with quotearchive.Reader(filename) as reader:
+            if not len(reader):
+                return None
+            return decodeQuote(reader.record(random.randrange(len(reader))))
+    quotes = loadQuotes(filename)
+    return random.choice(quotes) if quotes else None
+
+def savePickle(filename, obj):
+    """Pickle obj to a temporary file that then replaces filename."""
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as fh:
+        pickle.dump(obj, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, filename)
+
+def saveQuoteIndex(filename, index, stats):
+    savePickle(filename + INDEX_SUFFIX, index)
+    savePickle(filename + STATS_SUFFIX, stats)
+
+def loadStats(filename):
+    """The stats saved next to a quote file, or None."""
+    try:
+        with open(filename + STATS_SUFFIX, 'rb') as fh:
+            return pickle.load(fh)
+    except IOError:
+        return None
+    except (EOFError, pickle.UnpicklingError) as err:
+        logging.error('Broken quote stats %s: %s' % (filename, err))
+        return None
+
+def rebuildStats(quotes, *filenames):
+    """quoteStats for quotes, with the months of the old stats of filenames.
+
+    The months can't be counted again from the quotes, so they're carried
+    over as is: they tell how much was added when, even if some of those
+    have been removed since."""
+    stats = quoteStats(quotes)
+    for filename in filenames:
+        old = loadStats(filename)
+        if old is not None:
+            stats['months'].update(old['months'])
+    return stats
+
+def saveQuotes(filename, quotes, index=None, stats=None):
+    """Write a quote archive along with its index and stats.
+
+    Without stats, they're counted from quotes, keeping the old months."""
+    if index is None:
+        index = quoteIndex(quotes)
+    if stats is None:
+        stats = rebuildStats(quotes, filename)
+    quotearchive.write(filename, [encodeQuote(q) for q in quotes])
+    saveQuoteIndex(filename, index, stats)
+
 def quotemerge(a, b, result):
-    a = pickle.load(open(a, 'rb'))
-    b = pickle.load(open(b, 'rb'))
-    pickle.dump(a + b, open(result, 'wb'))
+    quotes = dedupeQuotes(loadQuotes(a) + loadQuotes(b))
+    saveQuotes(result, quotes, stats=rebuildStats(quotes, a, b))
+
+def quotededupe(filename):
+    """Remove duplicates from an existing quote file; returns how many.
+
+    Old pickled files come out as archives."""
+    quotes = loadQuotes(filename)
+    unique = dedupeQuotes(quotes)
+    saveQuotes(filename, unique)
+    return len(quotes) - len(unique)
 
 def getUserDesc(user):
     """Either "username" or "first last" (one of those should exist)
@@ -186,26 +661,98 @@ def getUserDesc(user):
                 user.get('first_name', ''),
                 user.get('last_name', '')))
 
+def quoteStatsMsg(stats, top=5):
+    """Human readable summary of quoteStats."""
+    def users(counter):
+        return ', '.join('%s (%d)' % (stats['names'].get(uid, '?'), n)
+                for uid, n in counter.most_common(top)) or '-'
+    months = sorted(stats['months'].items())[-6:]
+    return 'qstats: {} quotea\nQuotetuimmat: {}\nLisääjät: {}\nKuukausittain: {}'.format(
+            stats['total'], users(stats['origins']), users(stats['adders']),
+            ', '.join('%s: %d' % m for m in months) or '-')
+
 def getChatDesc(chat):
     """Either chat title or the user if it's a personal 1-on-1 chat
 
     Use only for human interaction, not for detecting stuff like with IDs"""
     return chat.get('title', getUserDesc(chat))
 
+class BroadcastHealth:
+    """Track the keulii broadcast targets that keep failing.
+
+    A chat that fails permanently (bot kicked or blocked, chat gone)
+    FAIL_LIMIT times in a row is dead and should be dropped. A successful send
+    resets the count. The counts survive restarts.
+    """
+    FAIL_LIMIT = 3
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(self.filename, 'rb') as fh:
+                self.failures = pickle.load(fh)
+        except IOError:
+            self.failures = {}
+
+    def save(self):
+        try:
+            with open(self.filename, 'wb') as fh:
+                pickle.dump(self.failures, fh)
+        except IOError:
+            logging.error('Cannot open broadcast health save %s' % self.filename)
+
+    def success(self, chat_id):
+        if self.failures.pop(chat_id, None) is not None:
+            self.save()
+
+    def failure(self, chat_id):
+        """Count one permanent failure; True if the chat is dead now."""
+        count = self.failures.get(chat_id, 0) + 1
+        dead = count >= self.FAIL_LIMIT
+        if dead:
+            self.failures.pop(chat_id, None)
+        else:
+            self.failures[chat_id] = count
+        self.save()
+        return dead
+
 
 class AskibotTg:
+    """One bot on one connection.
+
+    The keulii listener is not started if mopoposterport is None; a host may
+    then call sendMopoposter for it (see AskibotHost). The broadcast registry
+    is saved in statedir.
+    """
     MOPOPOSTER_SAVE_FILENAME = 'mopoposter.pickle'
-    def __init__(self, connection, keuliifilename, mopoposterport, quotesdir):
+    MOPOPOSTER_HEALTH_FILENAME = 'mopoposter_health.pickle'
+    def __init__(self, connection, keuliifilename, mopoposterport, quotesdir,
+            admins=(), statedir='.', keuliicorpus=None, diag=None):
         self.conn = connection
+        self.mopoposter_save = os.path.join(statedir,
+                self.MOPOPOSTER_SAVE_FILENAME)
+        # user ids allowed to use the maintenance commands
+        self.admins = set(admins)
+        # one per process; a host passes its own to all the bots
+        self.diagnostics = (diag if diag is not None
+                else diagnostics.Diagnostics(DIAG_DIR))
+        self.admission = AdmissionControl()
         self.update_offset = 0
+        self.poller = None
 
         try:
-            with open(self.MOPOPOSTER_SAVE_FILENAME, 'rb') as fh:
+            with open(self.mopoposter_save, 'rb') as fh:
                 self.mopoposter_broadcast = pickle.load(fh)
         except IOError:
             self.mopoposter_broadcast = {}
-        self.mopoposter = Mopoposter(mopoposterport, self.sendMopoposter)
-        self.keulii = Keulii(keuliifilename)
+        # the registry and health are used from the mopoposter thread too
+        self.mopoposter_lock = threading.Lock()
+        self.mopoposter_health = BroadcastHealth(os.path.join(statedir,
+                self.MOPOPOSTER_HEALTH_FILENAME))
+        self.mopoposter = None
+        if mopoposterport is not None:
+            self.mopoposter = Mopoposter(mopoposterport, self.sendMopoposter)
+        self.keulii = Keulii(keuliifilename, keuliicorpus)
         self.quotes = Quotes(quotesdir)
         # record the last /addq place to save the quote to the right place when
         # forwarded to the bot.
@@ -217,11 +764,12 @@ class AskibotTg:
         self.username = me['username']
 
     def saveMopoposterBroadcast(self):
+        """Call with mopoposter_lock held."""
         try:
-            with open(self.MOPOPOSTER_SAVE_FILENAME, 'wb') as fh:
+            with open(self.mopoposter_save, 'wb') as fh:
                 pickle.dump(self.mopoposter_broadcast, fh)
         except IOError:
-            logging.error('Cannot open mopoposter save %s' % self.MOPOPOSTER_SAVE_FILENAME)
+            logging.error('Cannot open mopoposter save %s' % self.mopoposter_save)
 
     def helpMsg(self):
         return '''Olen ASkiBot, killan irkistä tuttu robotti. Living tissue over metal endoskeleton.
@@ -232,6 +780,7 @@ class AskibotTg:
 
 /q HAKUTEKSTI - kuin mopoposter, mutta kanavakohtaisille quoteille.
 /addq - merkitse lisättävä quote tälle kanavalle. Lisää se sitten forwardaamalla yksityisesti botille.
+/qstats - kanavan quotetilastot.
 
 Bottia ylläpitää sooda. https://github.com/sooda/askibot-tg
 '''
@@ -240,12 +789,14 @@ Bottia ylläpitää sooda. https://github.com/sooda/askibot-tg
         """Start the main loop that goes on until user ^C's this."""
         self.running = True
         try:
-            self.mopoposter.start()
+            if self.mopoposter:
+                self.mopoposter.start()
             self.loopUpdates()
         except KeyboardInterrupt:
             pass
 
-        self.mopoposter.stop()
+        if self.mopoposter:
+            self.mopoposter.stop()
 
     def stop(self):
         # just for the tests
@@ -253,15 +804,46 @@ Bottia ylläpitää sooda. https://github.com/sooda/askibot-tg
 
     def sendMopoposter(self, msg):
         """Got a message, broadcast it to the listeners."""
-        for chatid in self.mopoposter_broadcast.keys():
-            self.conn.sendMessage(chatid, 'KEULII! ' + msg)
+        # copy; this runs in the mopoposter thread. the lock isn't held over
+        # the sends, so registrations don't wait for the network
+        with self.mopoposter_lock:
+            chatids = list(self.mopoposter_broadcast.keys())
+        for chatid in chatids:
+            try:
+                self.conn.sendMessage(chatid, 'KEULII! ' + msg)
+            except tgbot.TgbotPeerError as err:
+                logging.warning('Keulii to %s failed: %s' % (chatid, err))
+                with self.mopoposter_lock:
+                    dead = self.mopoposter_health.failure(chatid)
+                if dead:
+                    self.dropMopoposterTarget(chatid, err)
+            except tgbot.TgbotError as err:
+                # probably temporary, don't count it
+                logging.warning('Keulii to %s failed: %s' % (chatid, err))
+            else:
+                with self.mopoposter_lock:
+                    self.mopoposter_health.success(chatid)
+
+    def dropMopoposterTarget(self, chatid, err):
+        """Unregister a dead chat and tell the registrar if possible."""
+        with self.mopoposter_lock:
+            owner = self.mopoposter_broadcast.pop(chatid, None)
+            self.saveMopoposterBroadcast()
+        logging.warning('Unregistered dead keulii chat %s (owner %s): %s' % (
+            chatid, owner, err))
+        if owner is not None and owner != chatid:
+            try:
+                self.conn.sendMessage(owner,
+                        'Keuliiviestit lopetettu, kanava ei vastaa: ' + str(err))
+            except tgbot.TgbotError:
+                pass
 
     def loopUpdates(self):
+        self.poller = UpdatePoller(self.conn, self.update_offset)
         while self.running:
             # btw, looks like the server timeouts with status ok and an empty
             # result set after just 20 seconds
-            for update in self.conn.getUpdates(
-                    offset=self.update_offset, timeout=60):
+            for update in self.poller.poll():
                 self.handleUpdate(update)
 
     def handleUpdate(self, update):
@@ -272,7 +854,13 @@ Bottia ylläpitää sooda. https://github.com/sooda/askibot-tg
         except KeyError:
             logging.warning("what?? no message in update: <%s>" % update)
         else:
-            self.handleMessage(msg)
+            try:
+                with tracing.trace('update', '%s:%s' % (self.username, upid)):
+                    with tracing.span('handleMessage'):
+                        self.handleMessage(msg)
+            except tgbot.TgbotError as err:
+                # can't answer there; nothing to do about it
+                logging.warning('Api error for update %s: %s' % (upid, err))
         self.update_offset = upid + 1
 
     def handleMessage(self, msg):
@@ -288,14 +876,22 @@ Bottia ylläpitää sooda. https://github.com/sooda/askibot-tg
                     '/mopoposterpost': self.cmdMopoposterPost,
                     '/q': self.cmdQuote,
                     '/addq': self.cmdAddQuote,
+                    '/qstats': self.cmdQuoteStats,
+                    '/diag': self.cmdDiag,
             }
 
+            # one admission per message, even if it's both a forward and a
+            # command; None until asked
+            admitted = None
             if 'forward_from' in msg:
                 # this is a private message; from and chat are the same (the
                 # bot can't see public ones). forward_from is the original
                 # user, but the original chat is lost
-                self.cmdForwardedMessage(msg, msg['from'],
-                        msg['forward_from'])
+                admitted = self.admit(msg)
+                if admitted:
+                    with tracing.span('forward'):
+                        self.cmdForwardedMessage(msg, msg['from'],
+                                msg['forward_from'])
 
             try:
                 cmdname, args = text.split(' ', 1)
@@ -311,8 +907,24 @@ Bottia ylläpitää sooda. https://github.com/sooda/askibot-tg
             cmdname = cmdname.lower()
             # just silently ignore other commands: they may be directed to
             # other bots
-            if cmdname in commands:
-                commands[cmdname](args, msg['chat'], msg['from'])
+            if cmdname not in commands:
+                return
+            if admitted is None:
+                admitted = self.admit(msg)
+            if admitted:
+                with tracing.span(cmdname):
+                    commands[cmdname](args, msg['chat'], msg['from'])
+
+    def admit(self, msg):
+        """Rate limit before doing any work; admins always get through."""
+        user_id = msg['from']['id']
+        if user_id in self.admins:
+            return True
+        if self.admission.admit(msg['chat']['id'], user_id):
+            return True
+        logging.debug('Dropped over-limit message from %s in %s' % (
+            user_id, msg['chat']['id']))
+        return False
 
     def cmdHelp(self, text, chat, user):
         """Respond in the chat with the command list."""
@@ -332,12 +944,16 @@ Bottia ylläpitää sooda. https://github.com/sooda/askibot-tg
         """Register this chat to the keulii broadcast list."""
         # public and private registrations are accepted, chat is one of them
         title = getChatDesc(chat)
-        if self.mopoposter_broadcast.get(chat['id'], None):
+        with self.mopoposter_lock:
+            registered = bool(self.mopoposter_broadcast.get(chat['id'], None))
+            if not registered:
+                self.mopoposter_broadcast[chat['id']] = user['id']
+                self.saveMopoposterBroadcast()
+                self.mopoposter_health.success(chat['id'])
+        if registered:
             self.conn.sendMessage(user['id'],
                     'Pöh, keuliiviestit jo rekisteröity (' + title + ')')
         else:
-            self.mopoposter_broadcast[chat['id']] = user['id']
-            self.saveMopoposterBroadcast()
             self.conn.sendMessage(user['id'],
                     'OK, keuliiviestit rekisteröity: ' + title)
 
@@ -347,10 +963,12 @@ Bottia ylläpitää sooda. https://github.com/sooda/askibot-tg
         Others can re-register immediately and the ownership changes then.
         """
         title = getChatDesc(chat)
-        owner = self.mopoposter_broadcast.get(chat['id'], None)
+        with self.mopoposter_lock:
+            owner = self.mopoposter_broadcast.get(chat['id'], None)
+            if owner == user['id']:
+                del self.mopoposter_broadcast[chat['id']]
+                self.saveMopoposterBroadcast()
         if owner == user['id']:
-            del self.mopoposter_broadcast[chat['id']]
-            self.saveMopoposterBroadcast()
             self.conn.sendMessage(user['id'],
                     'OK, keuliiviestejä ei enää lähetetä: ' + title)
         elif owner is None:
@@ -387,14 +1005,23 @@ Bottia ylläpitää sooda. https://github.com/sooda/askibot-tg
         msgid = msg['message_id']
         text = msg['text']
 
-        quote = TgQuote(fwd_from, msgid, text, user)
-        self.quotes.addQuote(chat['id'], quote)
+        quote = TgQuote(fwd_from, msgid, text, user, msg.get('forward_date'))
+        del self.last_addq_chat[user['id']]
+        try:
+            added = self.quotes.addQuote(chat['id'], quote)
+        except ValueError as err:
+            logging.error('Cannot add quote to %s: %s' % (chat['id'], err))
+            self.conn.sendMessage(user['id'],
+                    'Virhe: kanavan quotetiedosto on rikki (' + getChatDesc(chat) + ')')
+            return
+        if not added:
+            self.conn.sendMessage(user['id'],
+                    'addq: Tämä on jo tallennettu (' + getChatDesc(chat) + ')')
+            return
 
         self.conn.sendMessage(chat['id'],
                 'addq ({} lisäsi) {}: {}'.format(getUserDesc(user), getUserDesc(fwd_from), text))
 
-        del self.last_addq_chat[user['id']]
-
     def cmdAddQuote(self, text, chat, user):
         """addq marks the chat to record the next forward on"""
         self.last_addq_chat[user['id']] = chat
@@ -402,14 +1029,153 @@ Bottia ylläpitää sooda. https://github.com/sooda/askibot-tg
         self.conn.sendMessage(user['id'],
                 'addq: Forwardaa viesti niin tallennan (' + title + ')')
 
+    def cmdQuoteStats(self, text, chat, user):
+        """Who gets quoted and who adds, from the precomputed stats."""
+        self.conn.sendMessage(chat['id'],
+                quoteStatsMsg(self.quotes.getStats(chat['id'])))
+
+    def cmdDiag(self, text, chat, user):
+        """Admin only: /diag stacks, /diag profile [SECONDS], /diag stop.
+
+        The results go to files on the bot's disk, the names privately to
+        the admin."""
+        if user['id'] not in self.admins:
+            return
+        args = text.split()
+        what = args[0] if args else 'stacks'
+        if what == 'stacks':
+            self.conn.sendMessage(user['id'],
+                    'diag: ' + self.diagnostics.dumpStacks())
+        elif what == 'profile':
+            seconds = int(args[1]) if len(args) > 1 and args[1].isdigit() else None
+            done = lambda filenames: self.sendDiagDone(user['id'], filenames)
+            if self.diagnostics.startProfile(seconds, done):
+                if tracemalloc.is_tracing():
+                    self.conn.sendMessage(user['id'], 'diag: profiling')
+                else:
+                    self.conn.sendMessage(user['id'], 'diag: profiling; '
+                            'memory covers only this run (no PYTHONTRACEMALLOC)')
+            else:
+                self.conn.sendMessage(user['id'], 'diag: already profiling')
+        elif what == 'stop':
+            self.diagnostics.stopProfile()
+        else:
+            self.conn.sendMessage(user['id'],
+                    'diag: stacks | profile [SECONDS] | stop')
+
+    def sendDiagDone(self, user_id, filenames):
+        """A profile run finished; called in the profiler thread."""
+        try:
+            self.conn.sendMessage(user_id, 'diag: ' + ' '.join(filenames))
+        except tgbot.TgbotError as err:
+            logging.warning('Cannot report diag results: %s' % err)
+
+class AskibotHost:
+    """Several bots with their own tokens in one process.
+
+    The keulii file is read and cached once for all, and there's just one
+    mopoposter listener that passes each message to every bot's own
+    broadcast list. The diagnostics are for the whole process too, as the
+    profiler samples every thread anyway. Everything else is per bot:
+    quotes, registrations, rate limits.
+
+    If one bot dies, the whole host stops with its error, like a single bot
+    would; a bot silently offline is worse.
+    """
+    def __init__(self, keuliifilename, mopoposterport):
+        self.keuliifilename = keuliifilename
+        self.corpus = KeuliiCorpus(keuliifilename)
+        self.mopoposter = Mopoposter(mopoposterport, self.sendMopoposter)
+        self.diagnostics = diagnostics.Diagnostics(DIAG_DIR)
+        self.bots = []
+        self.stopped = threading.Event()
+        self.error = None
+
+    def addBot(self, connection, quotesdir, statedir, admins=()):
+        bot = AskibotTg(connection, self.keuliifilename, None, quotesdir,
+                admins, statedir, self.corpus, self.diagnostics)
+        self.bots.append(bot)
+        return bot
+
+    def sendMopoposter(self, msg):
+        for bot in self.bots:
+            bot.sendMopoposter(msg)
+
+    def runBot(self, bot):
+        """Thread main for one bot; its end ends the host too."""
+        try:
+            bot.run()
+        except Exception as err:
+            logging.exception('Bot %s died' % bot.username)
+            if self.error is None:
+                self.error = err
+        if not self.stopped.is_set():
+            logging.error('Bot %s stopped, stopping all' % bot.username)
+            self.stopped.set()
+
+    def run(self):
+        """Run all bots in their own threads until user ^C's this or one of
+        them dies; then raise its error."""
+        threads = [threading.Thread(target=self.runBot, args=(bot,),
+            daemon=True) for bot in self.bots]
+        self.mopoposter.start()
+        try:
+            for thread in threads:
+                thread.start()
+            # a timeout to keep ^C working
+            while not self.stopped.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+
+        self.stop()
+        self.mopoposter.stop()
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        self.stopped.set()
+        for bot in self.bots:
+            bot.stop()
+
+def readAdmins(filename):
+    """One numeric user id per line; no file means no admins."""
+    try:
+        with open(filename) as fh:
+            return [int(line) for line in fh if line.strip()]
+    except IOError:
+        return []
+
 def main():
     logging.basicConfig(filename='debug.log', level=logging.DEBUG,
             format='%(asctime)s [%(levelname)-8s] %(message)s')
-    token = open(TOKEN_TXT).read().strip()
-    bot = AskibotTg(tgbot.TgbotConnection(token), KEULII_TXT,
-            MOPOPOSTERPORT, QUOTES_DIR)
-    print(bot.conn.getMe())
-    bot.run()
+    tokens = open(TOKEN_TXT).read().split()
+    if not tokens:
+        raise SystemExit('No bot tokens in %s' % TOKEN_TXT)
+    admins = readAdmins(ADMINS_TXT)
+    tracing.configure(TRACE_FILE, TRACE_SLOW)
+    if tracemalloc.is_tracing():
+        # PYTHONTRACEMALLOC; /diag profile memory snapshots see everything
+        logging.info('tracemalloc on since start')
+    if len(tokens) == 1:
+        bot = AskibotTg(tgbot.TgbotConnection(tokens[0]), KEULII_TXT,
+                MOPOPOSTERPORT, QUOTES_DIR, admins)
+        bot.diagnostics.installSignals()
+        print(bot.conn.getMe())
+        bot.run()
+        return
+
+    # many bots: the state of each goes to a directory named after the bot
+    host = AskibotHost(KEULII_TXT, MOPOPOSTERPORT)
+    for token in tokens:
+        conn = tgbot.TgbotConnection(token)
+        me = conn.getMe()
+        print(me)
+        statedir = me['username']
+        os.makedirs(os.path.join(statedir, QUOTES_DIR), exist_ok=True)
+        host.addBot(conn, os.path.join(statedir, QUOTES_DIR), statedir, admins)
+    host.diagnostics.installSignals()
+    host.run()
 
 if __name__ == '__main__':
     main()
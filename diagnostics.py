@@ -0,0 +1,138 @@
+"""Find out where a running bot spends its time: stacks, profiles, memory."""
+
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+class Diagnostics:
+    """Stack dumps and a sampling profiler, written to files in outdir.
+
+    The profiler looks at every thread's stack each INTERVAL seconds and
+    counts the identical ones. The result is in the folded format that
+    flamegraph.pl and speedscope read: "thread;outer;...;inner count". A
+    tracemalloc snapshot of the TOP_N biggest allocation sites is taken at
+    the end of the same run. That covers all live memory only if tracing
+    was on from the start (PYTHONTRACEMALLOC=1); otherwise it's started just
+    for the run and sees only what was allocated meanwhile, and the file is
+    named memory-window-* to tell.
+    """
+    INTERVAL = 0.01
+    TOP_N = 25
+    DEFAULT_SECONDS = 30
+
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self.thread = None
+        self.stopping = threading.Event()
+        # keeps the names unique within a second
+        self.serial = 0
+
+    def path(self, kind, ext):
+        os.makedirs(self.outdir, exist_ok=True)
+        self.serial += 1
+        return '%s/%s-%s-%d.%s' % (self.outdir, kind,
+                time.strftime('%Y%m%d-%H%M%S'), self.serial, ext)
+
+    def dumpStacks(self):
+        """Write the current stack of every thread to a file, return its name."""
+        names = {t.ident: t.name for t in threading.enumerate()}
+        filename = self.path('stacks', 'txt')
+        with open(filename, 'w') as fh:
+            for ident, frame in sys._current_frames().items():
+                fh.write('Thread %s (%s):\n' % (names.get(ident, '?'), ident))
+                fh.write(''.join(traceback.format_stack(frame)))
+                fh.write('\n')
+        logging.info('Stacks dumped to %s' % filename)
+        return filename
+
+    def profiling(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def startProfile(self, seconds=None, done=None):
+        """Sample for some seconds in the background; False if already busy.
+
+        done is called with the written filenames when finished."""
+        if self.profiling():
+            return False
+        if seconds is None:
+            seconds = self.DEFAULT_SECONDS
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.sampleLoop,
+                args=(seconds, done), daemon=True)
+        self.thread.start()
+        return True
+
+    def stopProfile(self):
+        """End a profile run early; the files are written anyway."""
+        self.stopping.set()
+
+    def sampleLoop(self, seconds, done):
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        samples = collections.Counter()
+        deadline = time.monotonic() + seconds
+        while (not self.stopping.wait(self.INTERVAL)
+                and time.monotonic() < deadline):
+            self.sample(samples)
+
+        snapshot = tracemalloc.take_snapshot()
+        if started_tracing:
+            tracemalloc.stop()
+        filenames = [self.writeProfile(samples),
+                self.writeMemory(snapshot, started_tracing)]
+        logging.info('Profile written to %s' % ', '.join(filenames))
+        if done is not None:
+            done(filenames)
+
+    def sample(self, samples):
+        """Count the current stack of each thread but this one."""
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (
+                    os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            samples[';'.join(reversed(stack))] += 1
+
+    def writeProfile(self, samples):
+        filename = self.path('profile', 'folded')
+        with open(filename, 'w') as fh:
+            for stack, count in samples.most_common():
+                fh.write('%s %d\n' % (stack, count))
+        return filename
+
+    def writeMemory(self, snapshot, window_only):
+        filename = self.path('memory-window' if window_only else 'memory', 'txt')
+        with open(filename, 'w') as fh:
+            if window_only:
+                fh.write('# only allocations made while profiling; '
+                        'run with PYTHONTRACEMALLOC=1 to see all\n')
+            for stat in snapshot.statistics('lineno')[:self.TOP_N]:
+                fh.write('%s\n' % stat)
+        return filename
+
+    def toggleProfile(self):
+        if self.profiling():
+            self.stopProfile()
+        else:
+            self.startProfile()
+
+    def installSignals(self):
+        """SIGUSR1 dumps the stacks, SIGUSR2 starts or stops profiling.
+
+        Works only from the main thread."""
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.dumpStacks())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.toggleProfile())
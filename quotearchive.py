@@ -0,0 +1,148 @@
+"""Compact quote files: length-prefixed records in zlib-compressed blocks.
+
+The layout:
+
+    MAGIC
+    block 0 ... block n-1     zlib of (4-byte length + record bytes)*
+    index                     per block: offset, compressed size, first record
+    trailer                   block count, record count, MAGIC
+
+Everything is big-endian. One record can be read by decompressing just its
+block, found from the index at the end of the file, so a Reader mmaps the
+file and touches only the parts it needs. Appending recompresses only the
+last block. Writes go to a temporary file that then replaces the old one,
+so a crash never leaves a half-written archive behind. The records are
+opaque bytes here.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import zlib
+
+MAGIC = b'ASKIQA01'
+BLOCK_RECORDS = 64
+INDEX_ENTRY = struct.Struct('>QII')
+TRAILER = struct.Struct('>II8s')
+LENGTH = struct.Struct('>I')
+
+def isArchive(filename):
+    with open(filename, 'rb') as fh:
+        return fh.read(len(MAGIC)) == MAGIC
+
+def packBlock(records):
+    return zlib.compress(b''.join(LENGTH.pack(len(r)) + r for r in records))
+
+def unpackBlock(data):
+    data = zlib.decompress(data)
+    records = []
+    pos = 0
+    while pos < len(data):
+        (length,) = LENGTH.unpack_from(data, pos)
+        pos += LENGTH.size
+        records.append(data[pos:pos + length])
+        pos += length
+    return records
+
+def writeBlocks(fh, offset, blocks, index, nrecords):
+    """Write blocks at offset, then the whole index and the trailer."""
+    fh.seek(offset)
+    for block, first in blocks:
+        index.append((fh.tell(), len(block), first))
+        fh.write(block)
+    for entry in index:
+        fh.write(INDEX_ENTRY.pack(*entry))
+    fh.write(TRAILER.pack(len(index), nrecords, MAGIC))
+    fh.truncate()
+
+def replaceFile(filename, head, offset, blocks, index, nrecords):
+    """Write head, then blocks at offset, index and trailer, atomically."""
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as fh:
+        fh.write(head)
+        writeBlocks(fh, offset, blocks, index, nrecords)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, filename)
+
+def write(filename, records):
+    blocks = [(packBlock(records[i:i + BLOCK_RECORDS]), i)
+            for i in range(0, len(records), BLOCK_RECORDS)]
+    replaceFile(filename, MAGIC, len(MAGIC), blocks, [], len(records))
+
+def append(filename, record):
+    """Add one record at the end, recompressing at most the last block.
+
+    The other blocks are copied as they are."""
+    with open(filename, 'rb') as fh:
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            index, nrecords = readIndex(data)
+            if index and nrecords - index[-1][2] < BLOCK_RECORDS:
+                offset, size, first = index.pop()
+                records = unpackBlock(data[offset:offset + size]) + [record]
+            else:
+                if index:
+                    offset, size, _ = index[-1]
+                    offset += size
+                else:
+                    offset = len(MAGIC)
+                first = nrecords
+                records = [record]
+            head = data[:offset]
+    replaceFile(filename, head, offset, [(packBlock(records), first)], index,
+            nrecords + 1)
+
+def readIndex(data):
+    """[(offset, size, first record)] and the record count from the file
+    contents, bytes or mmap."""
+    if len(data) < len(MAGIC) + TRAILER.size or data[:len(MAGIC)] != MAGIC:
+        raise ValueError('not a quote archive')
+    nblocks, nrecords, magic = TRAILER.unpack_from(data,
+            len(data) - TRAILER.size)
+    if magic != MAGIC:
+        raise ValueError('truncated quote archive')
+    start = len(data) - TRAILER.size - nblocks * INDEX_ENTRY.size
+    index = [INDEX_ENTRY.unpack_from(data, start + i * INDEX_ENTRY.size)
+            for i in range(nblocks)]
+    return index, nrecords
+
+class Reader:
+    """Random access to the records of an archive file through mmap."""
+    def __init__(self, filename):
+        with open(filename, 'rb') as fh:
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.index, self.nrecords = readIndex(self.map)
+        except ValueError:
+            self.map.close()
+            raise
+        self.firsts = [first for _, _, first in self.index]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.map.close()
+
+    def __len__(self):
+        return self.nrecords
+
+    def block(self, b):
+        offset, size, _ = self.index[b]
+        return unpackBlock(self.map[offset:offset + size])
+
+    def record(self, i):
+        if not 0 <= i < self.nrecords:
+            raise IndexError(i)
+        b = bisect.bisect_right(self.firsts, i) - 1
+        return self.block(b)[i - self.firsts[b]]
+
+    def records(self):
+        records = []
+        for b in range(len(self.index)):
+            records.extend(self.block(b))
+        return records
@@ -0,0 +1,12 @@
+#!/usr/bin/env python3
+# -*- encoding: utf8 -*-
+
+from sys import argv
+from askibot import quotededupe
+
+def main():
+	for filename in argv[1:]:
+		print('%s: %d duplicates removed' % (filename, quotededupe(filename)))
+
+if __name__ == '__main__':
+	main()
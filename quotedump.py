@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 # -*- encoding: utf8 -*-
 
-import pickle
 import collections
 import sys
+from askibot import loadQuotes
 
 # this just matches the actual version, pickle didn't like importing because namespace
+# (needed only for old pickled files, archives don't care)
 class TgQuote(collections.namedtuple('TgQuoteBase', 'origin msgid text adder')):
 	pass
 
@@ -14,6 +15,6 @@ def stringize(q):
 	msg = q.text
 	return "<%s (%s %s)> %s" % (user.get('username'), user.get('first_name'), user.get('last_name'), msg)
 
-qs = pickle.load(open(sys.argv[1], 'rb'))
+qs = loadQuotes(sys.argv[1])
 
 print("\n\n".join(map(stringize, qs)))
@@ -6,8 +6,8 @@ def rm():
     l = qs._listQuotes(chan_id)
     print(l[-2])
     del(l[-2])
-    with open('%s/%s' % (QUOTES_DIR, chan_id), 'wb') as fh:
-        pickle.dump(l, fh)
+    # rewrites the duplicate index too
+    saveQuotes('%s/%s' % (QUOTES_DIR, chan_id), l)
 
 if __name__ == '__main__':
     rm()
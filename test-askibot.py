@@ -2,12 +2,19 @@
 # -*- encoding: utf8 -*-
 
 import askibot
+import diagnostics
+import tracing
+import quotearchive
 import unittest
 import socket
 import tempfile
 import time
 import threading
 import shutil
+import pickle
+import os
+import json
+import unicodedata
 
 class TestMopoposterConn(unittest.TestCase):
     def testEmptyConn(self):
@@ -103,6 +110,78 @@ class TestMopoposterOps(unittest.TestCase):
             client.shutdown(socket.SHUT_RDWR)
             client.close()
 
+class UpdatesStub:
+    """Serves a fixed list of updates like getUpdates would."""
+    def __init__(self, n):
+        self.updates = [{'update_id': i} for i in range(n)]
+        self.requests = []
+
+    def getUpdates(self, offset, limit, timeout):
+        self.requests.append((offset, limit, timeout))
+        return self.updates[offset:offset+limit]
+
+class TestUpdatePoller(unittest.TestCase):
+    def testAll(self):
+        """Every update is received once, in order."""
+        conn = UpdatesStub(250)
+        poller = askibot.UpdatePoller(conn)
+        got = []
+        while len(got) < 250:
+            got.extend(poller.poll())
+        self.assertEqual(got, conn.updates)
+        self.assertEqual(poller.stats['updates'], 250)
+
+    def testLimitAdapts(self):
+        """Full batches grow the limit, empty polls shrink it back."""
+        conn = UpdatesStub(100)
+        poller = askibot.UpdatePoller(conn)
+        poller.poll()
+        poller.poll()
+        self.assertEqual(poller.limit, 4 * poller.MIN_LIMIT)
+        while poller.poll():
+            pass
+        self.assertEqual(poller.stats['empty_polls'], 1)
+        for i in range(5):
+            poller.poll()
+        self.assertEqual(poller.limit, poller.MIN_LIMIT)
+
+    def testTimeout(self):
+        """The server timeout is always asked for a long poll."""
+        conn = UpdatesStub(0)
+        poller = askibot.UpdatePoller(conn)
+        self.assertEqual(poller.poll(), [])
+        self.assertEqual(conn.requests,
+                [(0, poller.MIN_LIMIT, poller.POLL_TIMEOUT)])
+
+class TestAdmissionControl(unittest.TestCase):
+    def setUp(self):
+        self.adm = askibot.AdmissionControl()
+
+    def testUserBurst(self):
+        """One user gets a burst, then nothing; others can still talk."""
+        for i in range(self.adm.USER_BURST):
+            self.assertTrue(self.adm.admit('chan', 'user'))
+        self.assertFalse(self.adm.admit('chan', 'user'))
+        self.assertTrue(self.adm.admit('chan', 'other'))
+        self.assertEqual(self.adm.stats['rejected_user'], 1)
+
+    def testChatBurst(self):
+        """Many users together can't flood one chat, but rejected users
+        don't use up the chat's tokens."""
+        for i in range(self.adm.CHAT_BURST):
+            self.assertTrue(self.adm.admit('chan', 'user' + str(i)))
+        self.assertFalse(self.adm.admit('chan', 'another'))
+        self.assertTrue(self.adm.admit('elsewhere', 'another'))
+        self.assertEqual(self.adm.stats['rejected_chat'], 1)
+
+    def testRefill(self):
+        """Tokens come back with time."""
+        for i in range(self.adm.USER_BURST):
+            self.adm.admit('chan', 'user')
+        self.adm.users['user'].stamp -= 1 / self.adm.USER_RATE
+        self.assertTrue(self.adm.admit('chan', 'user'))
+        self.assertFalse(self.adm.admit('chan', 'user'))
+
 class TestKeulii(unittest.TestCase):
     def setUp(self):
         """One temporary file with dummy messages and a Keulii on it."""
@@ -163,6 +242,39 @@ class TestKeulii(unittest.TestCase):
         self.assertEqual(dest, 'user')
         self.assertEqual(msg, self.keulii.ERR_MSG)
 
+    def testFileChanges(self):
+        """New lines in the file are seen, also by a shared corpus."""
+        other = askibot.Keulii(self.datafile.name, self.keulii.corpus)
+        self.datafile.write(b'fourth line\n')
+        self.datafile.flush()
+        dest, msg = other.get('chan', 'user', 'fourth')
+        self.assertEqual(msg, 'fourth line')
+        dest, msg = self.keulii.get('chan', 'user', 'fourth')
+        self.assertEqual(msg, 'fourth line')
+
+    def testMixedEncodings(self):
+        """Both utf8 and latin-1 lines are found, case insensitively."""
+        self.datafile.write('Äiti utf\n'.encode('utf-8'))
+        self.datafile.write('äiti latin\n'.encode('latin-1'))
+        self.datafile.flush()
+        found = self.keulii.corpus.search('ÄITI')
+        self.assertEqual(found, ['Äiti utf', 'äiti latin'])
+
+    def testNormalized(self):
+        """Decomposed and composed forms match; accents only if asked."""
+        self.datafile.write('Ääliö\n'.encode('utf-8'))
+        self.datafile.flush()
+        decomposed = unicodedata.normalize('NFD', 'ääliö')
+        self.assertEqual(self.keulii.corpus.search(decomposed), ['Ääliö'])
+        self.assertEqual(self.keulii.corpus.search('aalio'), [])
+        corpus = askibot.KeuliiCorpus(self.datafile.name, fold_accents=True)
+        self.assertEqual(corpus.search('aalio'), ['Ääliö'])
+
+    def testMatchOnce(self):
+        """A line with many hits is still there just once."""
+        self.assertEqual(self.keulii.corpus.search('i'), self.lines)
+        self.assertEqual(self.keulii.corpus.search('line\nsecond'), [])
+
     def testTooOftenTimeout(self):
         """Same user on one channel can query again after the time limit."""
         self.keulii.get('chan', 'user', '')
@@ -222,6 +334,331 @@ class TestQuotes(unittest.TestCase):
                 self.assertEqual(dest, 'chan ' + str(i))
                 self.assertEqual(msg, 'msg ' + str(i))
 
+    def testDuplicate(self):
+        """The same quote twice is added just once, also when it differs
+        just by case or punctuation."""
+        self.assertTrue(self.quotes.addQuote('chan', 'Hello, world!'))
+        self.assertFalse(self.quotes.addQuote('chan', 'Hello, world!'))
+        self.assertFalse(self.quotes.addQuote('chan', 'hello world'))
+        self.assertTrue(self.quotes.addQuote('other', 'hello world'))
+        self.assertEqual(self.quotes._listQuotes('chan'), ['Hello, world!'])
+
+    def testTgDuplicate(self):
+        """Forwards are the same if the text is from the same user."""
+        alice, bob = {'id': 1}, {'id': 2}
+        self.quotes.addQuote('chan', askibot.TgQuote(alice, 10, 'hi', bob))
+        self.assertFalse(self.quotes.addQuote('chan',
+            askibot.TgQuote(alice, 11, 'Hi!', alice)))
+        self.assertTrue(self.quotes.addQuote('chan',
+            askibot.TgQuote(bob, 12, 'hi', bob)))
+
+    def testSameForward(self):
+        """The same message forwarded again is caught even if edited; the
+        same forward id from another adder is another message."""
+        alice, bob, carol = {'id': 5}, {'id': 1}, {'id': 2}
+        self.assertTrue(self.quotes.addQuote('chan',
+            askibot.TgQuote(alice, 50, 'first joke', bob, 1000)))
+        self.assertTrue(self.quotes.addQuote('chan',
+            askibot.TgQuote(alice, 50, 'totally different', carol, 2000)))
+        self.assertFalse(self.quotes.addQuote('chan',
+            askibot.TgQuote(alice, 51, 'first joke, edited', carol, 1000)))
+
+    def testNoWords(self):
+        """Quotes without any letters or digits aren't all the same."""
+        alice = {'id': 1}
+        self.assertTrue(self.quotes.addQuote('chan',
+            askibot.TgQuote(alice, 10, '😂😂', alice)))
+        self.assertTrue(self.quotes.addQuote('chan',
+            askibot.TgQuote(alice, 11, '👍', alice)))
+        self.assertTrue(self.quotes.addQuote('chan',
+            askibot.TgQuote(alice, 12, '!!!', alice)))
+        self.assertFalse(self.quotes.addQuote('chan',
+            askibot.TgQuote(alice, 13, '👍', alice)))
+
+    def testIndexPersisted(self):
+        """A new store on the same directory still knows the duplicates."""
+        self.quotes.addQuote('chan', 'a message')
+        quotes = askibot.Quotes(self.datadir)
+        self.assertFalse(quotes.addQuote('chan', 'a message'))
+
+    def testBrokenIndex(self):
+        """A truncated index is rebuilt from the quotes."""
+        self.quotes.addQuote('chan', 'a message')
+        with open(self.datadir + '/chan.index', 'wb') as fh:
+            fh.write(b'\x80')
+        quotes = askibot.Quotes(self.datadir)
+        self.assertFalse(quotes.addQuote('chan', 'a message'))
+        self.assertTrue(quotes.addQuote('chan', 'another message'))
+
+    def testDedupe(self):
+        """Old archives can be cleaned up in place."""
+        filename = self.datadir + '/chan'
+        with open(filename, 'wb') as fh:
+            pickle.dump(['a', 'b', 'A', 'c', 'b'], fh)
+        self.assertEqual(askibot.quotededupe(filename), 2)
+        self.assertEqual(self.quotes._listQuotes('chan'), ['a', 'b', 'c'])
+        self.assertFalse(self.quotes.addQuote('chan', 'c'))
+
+    def testStats(self):
+        """Stats follow the adds and survive a restart."""
+        alice = {'id': 1, 'username': 'alice'}
+        bob = {'id': 2, 'username': 'bob'}
+        self.quotes.addQuote('chan', askibot.TgQuote(alice, 10, 'hi', bob))
+        self.quotes.addQuote('chan', askibot.TgQuote(alice, 11, 'yo', bob))
+        self.quotes.addQuote('chan', askibot.TgQuote(bob, 12, 'hey', alice))
+        # duplicates don't count
+        self.quotes.addQuote('chan', askibot.TgQuote(bob, 13, 'hey', bob))
+
+        stats = askibot.Quotes(self.datadir).getStats('chan')
+        self.assertEqual(stats['total'], 3)
+        self.assertEqual(stats['origins'], {1: 2, 2: 1})
+        self.assertEqual(stats['adders'], {2: 2, 1: 1})
+        self.assertEqual(sum(stats['months'].values()), 3)
+        msg = askibot.quoteStatsMsg(stats)
+        self.assertIn('Quotetuimmat: alice (2), bob (1)', msg)
+
+    def testStatsDedupe(self):
+        """Cleaning up an archive keeps the monthly history."""
+        self.quotes.addQuote('chan', 'a')
+        self.quotes.addQuote('chan', 'b')
+        months = self.quotes.getStats('chan')['months'].copy()
+        self.assertEqual(askibot.quotededupe(self.datadir + '/chan'), 0)
+        stats = askibot.Quotes(self.datadir).getStats('chan')
+        self.assertEqual(stats['months'], months)
+        self.assertEqual(stats['total'], 2)
+
+    def testStatsMerge(self):
+        """Merged archives sum up the months of both."""
+        self.quotes.addQuote('a', 'x')
+        self.quotes.addQuote('b', 'y')
+        askibot.quotemerge(self.datadir + '/a', self.datadir + '/b',
+                self.datadir + '/c')
+        stats = self.quotes.getStats('c')
+        self.assertEqual(sum(stats['months'].values()), 2)
+
+    def testStatsOldArchive(self):
+        """Archives from before the stats get counted once."""
+        alice = {'id': 1, 'username': 'alice'}
+        with open(self.datadir + '/chan', 'wb') as fh:
+            pickle.dump([askibot.TgQuote(alice, 10, 'hi', alice)], fh)
+        stats = self.quotes.getStats('chan')
+        self.assertEqual(stats['total'], 1)
+        self.assertEqual(stats['origins'], {1: 1})
+
+    def testBrokenStats(self):
+        """Truncated stats are counted again from the quotes."""
+        alice = {'id': 1, 'username': 'alice'}
+        self.quotes.addQuote('chan', askibot.TgQuote(alice, 10, 'hi', alice))
+        with open(self.datadir + '/chan.stats', 'wb') as fh:
+            fh.write(b'\x80')
+        stats = askibot.Quotes(self.datadir).getStats('chan')
+        self.assertEqual(stats['total'], 1)
+        self.assertEqual(stats['origins'], {1: 1})
+
+    def testFailedWrite(self):
+        """A quote that couldn't be written isn't left in the cache."""
+        self.quotes.addQuote('chan', 'a message')
+        # the temporary file can't be created
+        os.mkdir(self.datadir + '/chan.tmp')
+        self.assertRaises(OSError, self.quotes.addQuote, 'chan', 'another')
+        os.rmdir(self.datadir + '/chan.tmp')
+        self.assertEqual(self.quotes.getStats('chan')['total'], 1)
+        self.assertTrue(self.quotes.addQuote('chan', 'another'))
+
+class TestQuoteArchive(unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.filename = self.datadir + '/archive'
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def testWriteRead(self):
+        """Records over many blocks come back in order, one by one too."""
+        records = [('record %d' % i).encode() for i in range(200)]
+        quotearchive.write(self.filename, records)
+        with quotearchive.Reader(self.filename) as reader:
+            self.assertEqual(len(reader), 200)
+            self.assertEqual(len(reader.index), 4)
+            self.assertEqual(reader.records(), records)
+            for i in (0, 63, 64, 199):
+                self.assertEqual(reader.record(i), records[i])
+
+    def testAppend(self):
+        """Appends fill the last block and then start new ones."""
+        quotearchive.write(self.filename, [])
+        records = [('record %d' % i).encode() for i in range(130)]
+        for record in records:
+            quotearchive.append(self.filename, record)
+        with quotearchive.Reader(self.filename) as reader:
+            self.assertEqual(len(reader.index), 3)
+            self.assertEqual(reader.records(), records)
+            self.assertEqual(reader.record(129), records[129])
+
+    def testQuotes(self):
+        """TgQuotes and plain strings survive the trip."""
+        quotes = [askibot.TgQuote({'id': 1, 'username': 'ö'}, 5, 'hi',
+            {'id': 2}), 'plain']
+        askibot.saveQuotes(self.filename, quotes)
+        self.assertEqual(askibot.loadQuotes(self.filename), quotes)
+        self.assertIsInstance(askibot.loadQuotes(self.filename)[0],
+                askibot.TgQuote)
+
+    def testBroken(self):
+        """A cut archive reads as no quotes and doesn't crash anything."""
+        quotes = askibot.Quotes(self.datadir)
+        quotes.addQuote('chan', 'a quote')
+        filename = self.datadir + '/chan'
+        with open(filename, 'r+b') as fh:
+            fh.truncate(os.path.getsize(filename) - 4)
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(quotes.get('chan', 'user', ''), ('chan', None))
+            self.assertEqual(quotes.get('chan', 'user', 'quote'),
+                    ('chan', None))
+        self.assertRaises(ValueError, quotes.addQuote, 'chan', 'another')
+
+    def testNoTempLeft(self):
+        """Writes go through a temporary file that is renamed over."""
+        quotearchive.write(self.filename, [b'a'])
+        quotearchive.append(self.filename, b'b')
+        self.assertEqual(os.listdir(self.datadir), ['archive'])
+
+    def testConvertPickle(self):
+        """An old pickled file becomes an archive on the next add."""
+        with open(self.datadir + '/chan', 'wb') as fh:
+            pickle.dump(['old'], fh)
+        quotes = askibot.Quotes(self.datadir)
+        self.assertEqual(quotes.get('chan', 'user', '')[1], 'old')
+        quotes.addQuote('chan', 'new')
+        self.assertTrue(quotearchive.isArchive(self.datadir + '/chan'))
+        self.assertEqual(quotes._listQuotes('chan'), ['old', 'new'])
+
+class TestBroadcastHealth(unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.filename = self.datadir + '/health'
+        self.health = askibot.BroadcastHealth(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def testDead(self):
+        """Enough failures in a row kill a chat."""
+        for i in range(self.health.FAIL_LIMIT - 1):
+            self.assertFalse(self.health.failure('chan'))
+        self.assertTrue(self.health.failure('chan'))
+
+    def testSuccessResets(self):
+        """A successful send in between starts the count over."""
+        for i in range(self.health.FAIL_LIMIT - 1):
+            self.health.failure('chan')
+        self.health.success('chan')
+        self.assertFalse(self.health.failure('chan'))
+
+    def testPersisted(self):
+        """Counts are remembered over a restart."""
+        for i in range(self.health.FAIL_LIMIT - 1):
+            self.health.failure('chan')
+        health = askibot.BroadcastHealth(self.filename)
+        self.assertTrue(health.failure('chan'))
+
+class TestApiError(unittest.TestCase):
+    def testPeerErrors(self):
+        """Dead chat errors are told apart from the rest, whatever the
+        format of the day."""
+        for desc in ('Error: PEER_ID_INVALID',
+                '[Error : 400 : PEER_ID_INVALID]',
+                'Error: Bot was kicked from a chat',
+                '[Error]: Bot was blocked by the user'):
+            err = askibot.tgbot.apiError({'ok': False, 'description': desc})
+            self.assertIsInstance(err, askibot.tgbot.TgbotPeerError)
+
+        err = askibot.tgbot.apiError({'ok': False, 'error_code': 500,
+            'description': 'Internal server error: restart'})
+        self.assertNotIsInstance(err, askibot.tgbot.TgbotPeerError)
+        self.assertEqual(err.error_code, 500)
+
+class TestDiagnostics(unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.diag = diagnostics.Diagnostics(self.datadir + '/diag')
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def testStacks(self):
+        """All threads are in the dump."""
+        with open(self.diag.dumpStacks()) as fh:
+            self.assertIn('MainThread', fh.read())
+        # no overwrites within the same second
+        self.assertNotEqual(self.diag.dumpStacks(), self.diag.dumpStacks())
+
+    def testProfile(self):
+        """A short run writes a folded profile and a memory snapshot."""
+        result = []
+        done = threading.Event()
+        def finished(filenames):
+            result.extend(filenames)
+            done.set()
+
+        self.assertTrue(self.diag.startProfile(0.1, finished))
+        self.assertFalse(self.diag.startProfile(0.1))
+        done.wait()
+        profile, memory = result
+        with open(profile) as fh:
+            lines = fh.read().splitlines()
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertTrue(count.isdigit())
+        self.assertTrue(any(line.startswith('MainThread;') for line in lines))
+        self.assertTrue(os.path.exists(memory))
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.filename = self.datadir + '/trace.json'
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def events(self):
+        with open(self.filename) as fh:
+            return json.loads(fh.read().rstrip().rstrip(',') + ']')
+
+    def testSlowKept(self):
+        """A slow trace is written with all its spans."""
+        tracer = tracing.Tracer(self.filename, slow=0)
+        with tracer.trace('update', 'bot:1'):
+            with tracer.span('cmd', arg=1):
+                pass
+            with tracer.span('sendMessage'):
+                pass
+        events = self.events()
+        self.assertEqual([e['name'] for e in events],
+                ['cmd', 'sendMessage', 'update'])
+        for event in events:
+            self.assertEqual(event['ph'], 'X')
+            self.assertEqual(event['args']['trace_id'], 'bot:1')
+
+    def testFastDropped(self):
+        """Fast traces and spans outside any trace leave no trace."""
+        tracer = tracing.Tracer(self.filename, slow=60)
+        with tracer.trace('update', 'bot:1'):
+            with tracer.span('cmd'):
+                pass
+        with tracer.span('lonely'):
+            pass
+        self.assertFalse(os.path.exists(self.filename))
+
+    def testRollover(self):
+        """A big file is moved aside and a new one started."""
+        tracer = tracing.Tracer(self.filename, slow=0, max_bytes=1)
+        for i in range(2):
+            with tracer.trace('update', i):
+                pass
+        self.assertEqual(len(self.events()), 1)
+        self.assertTrue(os.path.exists(self.filename + '.1'))
+
 class TgbotConnStub:
     """Fake connection for the tgbot to test without actual tg.
 
@@ -233,6 +670,8 @@ class TgbotConnStub:
         self.outmsg = threading.Event()
         self.outidx = 0
         self.username = 'ASkiBot'
+        # chats that the bot has been kicked from
+        self.dead = set()
 
     def queue(self, msg):
         """To the bot."""
@@ -254,21 +693,77 @@ class TgbotConnStub:
 
     def sendMessage(self, chat_id, text):
         """To the server."""
+        if chat_id in self.dead:
+            raise askibot.tgbot.TgbotPeerError({'ok': False, 'error_code': 403,
+                'description': 'Forbidden: bot was kicked from the group chat'})
         self.outgoing.append((chat_id, text))
         self.outmsg.set()
 
     def getMe(self):
         return {'username': self.username}
 
+class TestAskibotHost(unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.keuliifile = tempfile.NamedTemporaryFile()
+        self.host = askibot.AskibotHost(self.keuliifile.name, 12347)
+        self.conns = []
+        for name in ('bot1', 'bot2'):
+            conn = TgbotConnStub()
+            conn.username = name
+            self.conns.append(conn)
+            self.host.addBot(conn, self.datadir, self.datadir + '/' + name)
+            os.mkdir(self.datadir + '/' + name)
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+        self.keuliifile.close()
+
+    def testShared(self):
+        """The bots read the same corpus but keep their own state."""
+        bot1, bot2 = self.host.bots
+        self.assertIs(bot1.keulii.corpus, bot2.keulii.corpus)
+        self.assertIs(bot1.diagnostics, self.host.diagnostics)
+        self.assertIs(bot2.diagnostics, self.host.diagnostics)
+        self.assertIsNone(bot1.mopoposter)
+        bot1.mopoposter_broadcast[42] = 1337
+        bot1.saveMopoposterBroadcast()
+        self.assertEqual(bot2.mopoposter_broadcast, {})
+        self.assertTrue(os.path.exists(
+            self.datadir + '/bot1/' + bot1.MOPOPOSTER_SAVE_FILENAME))
+
+    def testFanOut(self):
+        """One keulii goes to the listeners of every bot."""
+        bot1, bot2 = self.host.bots
+        bot1.mopoposter_broadcast[42] = 1337
+        bot2.mopoposter_broadcast[43] = 1337
+        self.host.sendMopoposter('hello')
+        self.assertEqual(self.conns[0].read(), (42, 'KEULII! hello'))
+        self.assertEqual(self.conns[1].read(), (43, 'KEULII! hello'))
+
+    def testBotDies(self):
+        """One bot crashing stops the host with that error."""
+        class Crash(Exception):
+            pass
+        def crash(**kwargs):
+            raise Crash()
+        self.conns[1].getUpdates = crash
+        # the other one just idles
+        self.conns[0].inmsg.set()
+        with self.assertLogs(level='ERROR'):
+            self.assertRaises(Crash, self.host.run)
+        self.assertFalse(self.host.bots[0].running)
+
 class testAskibot(unittest.TestCase):
     def setUp(self):
         self.conn = TgbotConnStub()
 
         self.keuliifile = tempfile.NamedTemporaryFile()
         self.mopoposterport = 12345
+        self.datadir = tempfile.mkdtemp()
 
         self.bot = askibot.AskibotTg(self.conn, self.keuliifile.name,
-                self.mopoposterport, 'quotes')
+                self.mopoposterport, self.datadir, statedir=self.datadir)
         self.botthread = threading.Thread(target=lambda: self.bot.run())
         self.botthread.start()
         self.msgid = 0
@@ -278,6 +773,10 @@ class testAskibot(unittest.TestCase):
 
     def tearDown(self):
         self.bot.stop()
+        # wake up a poll that would wait for messages forever
+        self.conn.inmsg.set()
+        self.botthread.join()
+        shutil.rmtree(self.datadir)
 
     def groupMsg(self, group, sender, text):
         """A generic group message block with increasing msgid."""
@@ -303,6 +802,48 @@ class testAskibot(unittest.TestCase):
         self.assertEqual(group, self.group['id'])
         self.assertTrue(msg.startswith('Olen ASkiBot'))
 
+    def testFlood(self):
+        """Commands over the limit get no answer at all."""
+        burst = self.bot.admission.USER_BURST
+        for i in range(burst + 1):
+            self.queue(self.group, self.user, '/help')
+        # something after the flood to know when the bot got that far
+        self.bot.admins.add(1)
+        self.queue(self.group, {'id': 1, 'username': 'admin'}, '/start')
+        for i in range(burst):
+            group, msg = self.conn.read()
+            self.assertTrue(msg.startswith('Olen ASkiBot'))
+        self.assertEqual(self.conn.read(), (self.group['id'], 'please stop'))
+        self.assertEqual(self.bot.admission.stats['rejected_user'], 1)
+
+    def testForwardedCommandAdmittedOnce(self):
+        """A forward that looks like a command costs one token."""
+        private = {'id': self.user['id'], 'username': 'dude'}
+        msg = self.groupMsg(private, self.user, '/help')
+        msg['message']['forward_from'] = {'id': 1, 'username': 'other'}
+        self.conn.queue(msg)
+        self.msgid += 1
+        self.conn.read() # no /addq first
+        self.conn.read() # the help
+        self.assertEqual(self.bot.admission.stats['admitted'], 1)
+
+    def testDeadBroadcast(self):
+        """A chat that keeps failing is unregistered, for good, and the
+        registrar hears about it."""
+        self.bot.mopoposter_broadcast[self.group['id']] = self.user['id']
+        self.conn.dead.add(self.group['id'])
+        for i in range(self.bot.mopoposter_health.FAIL_LIMIT - 1):
+            self.bot.sendMopoposter('hello')
+            self.assertIn(self.group['id'], self.bot.mopoposter_broadcast)
+        self.bot.sendMopoposter('hello')
+
+        self.assertNotIn(self.group['id'], self.bot.mopoposter_broadcast)
+        with open(self.bot.mopoposter_save, 'rb') as fh:
+            self.assertEqual(pickle.load(fh), {})
+        user, msg = self.conn.read()
+        self.assertEqual(user, self.user['id'])
+        self.assertTrue(msg.startswith('Keuliiviestit lopetettu'))
+
     # ... FIXME
 
 
@@ -1,88 +1,107 @@
 import requests
 import logging
+import tracing
+
+class TgbotError(Exception):
+    """The api answered with ok=false."""
+    def __init__(self, response):
+        super().__init__(response.get('description', 'no description'))
+        self.response = response
+        self.error_code = response.get('error_code')
+
+class TgbotPeerError(TgbotError):
+    """The chat can't be talked to anymore; retrying won't help."""
+
+# tg changes these all the time, so match just the interesting part. seen so
+# far e.g. 'Error: PEER_ID_INVALID', '[Error : 400 : PEER_ID_INVALID]',
+# 'Error: Bot was kicked from a chat', '[Error]: Bot was blocked by the user'
+PEER_ERRORS = (
+    'peer_id_invalid',
+    'bot was kicked',
+    'bot was blocked',
+    'chat not found',
+    'user is deactivated',
+)
+
+def apiError(response):
+    """Exception for a failed api response."""
+    description = response.get('description', '').lower()
+    if response.get('error_code') == 403:
+        # forbidden: blocked, kicked, or not allowed to talk there at all
+        return TgbotPeerError(response)
+    if any(err in description for err in PEER_ERRORS):
+        return TgbotPeerError(response)
+    return TgbotError(response)
 
 class TgbotConnection:
     REQUEST_TIMEOUT = 30
+    # extra client-side wait on top of a long poll's server timeout, so that
+    # an idle poll ends with an empty result instead of a client timeout
+    LONGPOLL_MARGIN = 10
     def __init__(self, token):
         self.token = token
 
     def apiurl(self, method):
         return 'https://api.telegram.org/bot{}/{}'.format(self.token, method)
 
-    def makeRequest(self, reqname, **params):
+    def makeRequest(self, reqname, request_timeout=None, **params):
+        if request_timeout is None:
+            request_timeout = self.REQUEST_TIMEOUT
         retries = 0
         while True:
             retries += 1
-            logging.debug('>>> {}: {}'.format(reqname, params))
-            try:
-                response = requests.get(self.apiurl(reqname),
-                        params=params, timeout=self.REQUEST_TIMEOUT)
-            except requests.exceptions.ConnectionError as ex:
-                logging.warning('Connection error ({}) for  {} (try #{}), params: {}'.format(
-                    ex, reqname, retries, params))
-                continue
-            except requests.exceptions.Timeout: # XXX install newer version
-                logging.warning('Timed out {} (try #{}), params: {}'.format(
-                    reqname, retries, params))
-                continue
-            except requests.exceptions.ConnectTimeout: # XXX install newer version
-                logging.warning('Timed out {} (try #{}), params: {}'.format(
-                    reqname, retries, params))
-                continue
+            # one span per attempt, to see the retries
+            with tracing.span(reqname, attempt=retries):
+                logging.debug('>>> {}: {}'.format(reqname, params))
+                try:
+                    response = requests.get(self.apiurl(reqname),
+                            params=params, timeout=request_timeout)
+                except requests.exceptions.ConnectionError as ex:
+                    logging.warning('Connection error ({}) for  {} (try #{}), params: {}'.format(
+                        ex, reqname, retries, params))
+                    continue
+                except requests.exceptions.Timeout: # XXX install newer version
+                    logging.warning('Timed out {} (try #{}), params: {}'.format(
+                        reqname, retries, params))
+                    continue
+                except requests.exceptions.ConnectTimeout: # XXX install newer version
+                    logging.warning('Timed out {} (try #{}), params: {}'.format(
+                        reqname, retries, params))
+                    continue
 
-            response.encoding = 'utf-8'
-            # version mismatches in our installs
-            try:
-                json = response.json()
-            except TypeError:
-                json = response.json
-            logging.debug('<<< {}'.format(json))
+                response.encoding = 'utf-8'
+                # version mismatches in our installs
+                try:
+                    json = response.json()
+                except TypeError:
+                    json = response.json
+                logging.debug('<<< {}'.format(json))
 
-            # error 502 happens sometimes
-            if json is None:
-                logging.warning('none json response for {} (try #{})'.format(
-                    reqname, retries))
-                continue
+                # error 502 happens sometimes
+                if json is None:
+                    logging.warning('none json response for {} (try #{})'.format(
+                        reqname, retries))
+                    continue
 
-            if not json['ok']:
-                return # tg changes these all the time. i don't even care anymore
-                if json.get('description') == 'Error: PEER_ID_INVALID': # (FIXME: is this old format? the next one seems o be used, hmm?)
-                    # happens for sendMessage sometimes. FIXME: what makes the peer invalid?
-                    # return value can be ignored here for now
-                    logging.error('FIXME: what is this?')
-                    return
-                if json.get('description') == '[Error : 400 : PEER_ID_INVALID]':
-                    logging.error('FIXME: what is this?')
-                    return
-                if json.get('description') == '[Error]: PEER_ID_INVALID':
-                    # happens for sendMessage sometimes. FIXME: what makes the peer invalid?
-                    # return value can be ignored here for now
-                    logging.error('FIXME: what is this?')
-                    return
-                if json.get('description') == '[Error]: Bad Request: message not found':
-                    # got this for cmdQuote self.conn.forwardMessage(target, response.adder['id'], response.msgid)
-                    # return value can be ignored here for now
-                    logging.error('FIXME: what is this?')
-                    return
-                if json.get('description') == 'Error: Bot was kicked from a chat':
-                    logging.warning('FIXME: handle this somehow?')
-                    return
-                if json.get('description') == '[Error]: Bot was blocked by the user':
-                    logging.warning('FIXME: handle this somehow?')
-                    return
-                raise RuntimeError('Bad request, response: {}'.format(json))
-            return json['result']
+                if not json['ok']:
+                    raise apiError(json)
+                return json['result']
 
     def getMe(self):
         return self.makeRequest('getMe')
 
     def getUpdates(self, offset=None, limit=None, timeout=None):
-        # FIXME handle this stupid stuff like:
-        # {'error_code': 500, 'ok': False, 'description': 'Internal server error: restart'}
-        updates = self.makeRequest('getUpdates', offset=offset, limit=limit, timeout=timeout)
-        if updates is None:
+        request_timeout = None
+        if timeout:
+            request_timeout = timeout + self.LONGPOLL_MARGIN
+        try:
+            return self.makeRequest('getUpdates', request_timeout,
+                    offset=offset, limit=limit, timeout=timeout)
+        except TgbotError as err:
+            # stupid stuff like:
+            # {'error_code': 500, 'ok': False, 'description': 'Internal server error: restart'}
+            logging.warning('getUpdates failed: {}'.format(err.response))
             return [] # ON ERROR RESUME NEXT :-D
-        return updates
 
     def sendMessage(self, chat_id, text):
         return self.makeRequest('sendMessage', chat_id=chat_id, text=text)
@@ -0,0 +1,103 @@
+"""Per-request traces in the Chrome trace event format, slow ones only.
+
+A trace starts with trace() around one unit of work, such as an update, and
+collects the span() calls made in the same thread until it ends. Only traces
+that took at least the slow threshold are written, so the fast majority
+costs just some list appends. Without configure() everything is a no-op.
+
+The output loads in chrome://tracing or ui.perfetto.dev as is. It's a JSON
+array with no closing bracket, which both of them accept, so events can be
+appended to it.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+class Tracer:
+    def __init__(self, filename, slow=1.0, max_bytes=10*1024*1024):
+        self.filename = filename
+        self.slow = slow
+        # the file rolls over to filename.1 when it gets this big
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    @contextlib.contextmanager
+    def trace(self, name, trace_id, **args):
+        if getattr(self.local, 'events', None) is not None:
+            # already in one; this is just a part of it
+            with self.span(name, **args):
+                yield
+            return
+
+        self.local.events = []
+        self.local.trace_id = trace_id
+        start = time.perf_counter()
+        try:
+            with self.span(name, **args):
+                yield
+        finally:
+            events = self.local.events
+            self.local.events = None
+            if time.perf_counter() - start >= self.slow:
+                self.write(events)
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        events = getattr(self.local, 'events', None)
+        if events is None:
+            yield
+            return
+
+        wallclock = time.time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            args['trace_id'] = self.local.trace_id
+            events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': int(wallclock * 1e6),
+                'dur': int((time.perf_counter() - start) * 1e6),
+                'pid': self.pid,
+                'tid': threading.get_ident(),
+                'args': args,
+            })
+
+    def write(self, events):
+        with self.lock:
+            try:
+                if os.path.getsize(self.filename) > self.max_bytes:
+                    os.replace(self.filename, self.filename + '.1')
+            except OSError:
+                pass
+            new = not os.path.exists(self.filename)
+            with open(self.filename, 'a') as fh:
+                if new:
+                    fh.write('[\n')
+                for event in events:
+                    fh.write(json.dumps(event, default=str) + ',\n')
+
+_tracer = None
+_null = contextlib.nullcontext()
+
+def configure(filename, slow=1.0, max_bytes=10*1024*1024):
+    """Start tracing for the whole process."""
+    global _tracer
+    _tracer = Tracer(filename, slow, max_bytes)
+    return _tracer
+
+def trace(name, trace_id, **args):
+    if _tracer is None:
+        return _null
+    return _tracer.trace(name, trace_id, **args)
+
+def span(name, **args):
+    if _tracer is None:
+        return _null
+    return _tracer.span(name, **args)